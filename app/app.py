@@ -1,48 +1,151 @@
-from flask import Flask, jsonify, render_template, request, send_from_directory, Response
-from study_service import create_study_tree, generate_planet_transition_message
-from tts_service import text_to_speech
+from flask import Flask, jsonify, render_template, request, send_from_directory, Response, stream_with_context
+from study_service import create_study_tree, stream_study_tree, generate_planet_transition_message, warm_cache
+from flask_compress import Compress
+from tts_service import text_to_speech_stream, tts_cache_filename, mark_cached_audio_used
 import os
+import math
+import atexit
+import queue
+import logging
+import logging.handlers
+import threading
+import orjson
+from jinja2 import FileSystemBytecodeCache
+
+def configure_logging():
+    """
+    Send the "truecopilot" logger (also app.logger) through a queue, so request
+    threads only enqueue records and a background listener does the writing.
+    The level comes from LOG_LEVEL (e.g. WARNING in production).
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%H:%M:%S"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    logger = logging.getLogger("truecopilot")
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    return logger
+
+logger = configure_logging()
 
 app = Flask("truecopilot", static_folder=None)
 
+# Study trees repeat the same field names dozens of times, so gzip shrinks them several times over
+app.config["COMPRESS_MIMETYPES"] = ["application/json", "text/html"]
+app.config["COMPRESS_LEVEL"] = 6
+app.config["COMPRESS_MIN_SIZE"] = 500
+# Compressing a streamed response buffers all of it first, which would defeat the NDJSON endpoint
+app.config["COMPRESS_STREAMS"] = False
+Compress(app)
+
+# Reuse compiled templates across restarts and workers, and compile them now rather than on the first request.
+# With no directory, Jinja uses a per-user cache dir that it creates as 0700 and checks the owner of.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
+def start_cache_warming():
+    """
+    Pre-generate study trees for popular topics in the background, so the first
+    request for them is a cache hit. Off unless WARM_POPULAR_TOPICS=1, since it
+    spends API quota.
+    """
+    if os.getenv("WARM_POPULAR_TOPICS") != "1":
+        return
+    topics_path = os.path.join(os.path.dirname(__file__), 'popular_topics.txt')
+    with open(topics_path, 'r', encoding='utf-8') as f:
+        topics = [line.strip() for line in f if line.strip()]
+    threading.Thread(target=warm_cache, args=(topics,), name="cache-warmer", daemon=True).start()
+
+start_cache_warming()
+
+def json_response(payload, status=200):
+    """Serialize a payload with orjson, which is much faster than jsonify for large study trees."""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
 @app.route("/")
 def index():
     return render_template('index.html')
 
+# Audio files never change once written, so let browsers and CDNs keep them for a year
+AUDIO_MAX_AGE = 365 * 24 * 60 * 60
+
 @app.route("/audio/<filename>")
 def serve_audio(filename):
     """Serve audio files from the audio directory."""
     audio_dir = os.path.join(os.path.dirname(__file__), 'audio')
-    return send_from_directory(audio_dir, filename)
+    # send_from_directory adds an ETag and answers If-None-Match with 304 Not Modified
+    response = send_from_directory(audio_dir, filename, max_age=AUDIO_MAX_AGE)
+    # Generated speech can be evicted from the cache, so count plays through this URL as uses
+    mark_cached_audio_used(filename)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def parse_study_request(data):
+    """Read the topic and a validated questions_per_subtopic from a study request body."""
+    topic = data.get('topic', '').strip()
+    questions_per_subtopic = data.get('questions_per_subtopic', 3)
+    
+    # Clamp questions_per_subtopic to 1-10 without ever raising. JSON numbers
+    # (including 5.7 and true) are truncated like int() does; strings must be a
+    # short whole number, since int() rejects digit strings over 4300 characters;
+    # anything else falls back to 3
+    if isinstance(questions_per_subtopic, (int, float)) and math.isfinite(questions_per_subtopic):
+        value = int(questions_per_subtopic)
+    else:
+        text = str(questions_per_subtopic).strip()
+        value = int(text) if len(text) <= 4 and text.removeprefix('-').isdecimal() else 3
+    questions_per_subtopic = max(1, min(10, value))
+    
+    return topic, questions_per_subtopic
 
 @app.route("/api/generate-study", methods=["POST"])
 def generate_study():
     """Generate a study tree for a given topic."""
     try:
-        data = request.get_json()
-        topic = data.get('topic', '').strip()
-        questions_per_subtopic = data.get('questions_per_subtopic', 3)
+        topic, questions_per_subtopic = parse_study_request(request.get_json())
         
         if not topic:
             return jsonify({"error": "Topic is required"}), 400
         
-        # Validate questions_per_subtopic
-        try:
-            questions_per_subtopic = int(questions_per_subtopic)
-            if questions_per_subtopic < 1 or questions_per_subtopic > 10:
-                questions_per_subtopic = 3
-        except (ValueError, TypeError):
-            questions_per_subtopic = 3
-        
         # Generate the study tree
         study_tree = create_study_tree(topic, questions_per_subtopic)
         
-        return jsonify(study_tree), 200
+        return json_response(study_tree)
         
     except Exception as e:
-        print(f"Error generating study tree: {e}")
+        logger.error("Error generating study tree: %s", e)
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/generate-study-stream", methods=["POST"])
+def generate_study_stream():
+    """Stream a study tree as NDJSON, one line per sub topic as soon as its questions are ready."""
+    try:
+        topic, questions_per_subtopic = parse_study_request(request.get_json())
+        
+        if not topic:
+            return jsonify({"error": "Topic is required"}), 400
+        
+        return Response(
+            stream_with_context(stream_study_tree(topic, questions_per_subtopic)),
+            mimetype='application/x-ndjson'
+        )
+        
+    except Exception as e:
+        logger.error("Error streaming study tree: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def _prepend_chunk(first_chunk, chunks):
+    """Yield first_chunk, then the rest; closing this also closes chunks."""
+    yield first_chunk
+    yield from chunks
+
 @app.route("/api/tts", methods=["POST"])
 def tts():
     """Convert text to speech using ElevenLabs."""
@@ -53,24 +156,28 @@ def tts():
         if not text:
             return jsonify({"error": "Text is required"}), 400
         
-        # Generate speech
-        audio_data = text_to_speech(text)
+        # Generate speech. Wait for the first chunk here so API and
+        # configuration errors still turn into JSON error responses
+        audio_chunks = text_to_speech_stream(text)
+        first_chunk = next(audio_chunks, b"")
         
-        # Return audio as MP3
+        # Stream audio as MP3 while the rest is still being generated
         return Response(
-            audio_data,
+            _prepend_chunk(first_chunk, audio_chunks),
             mimetype='audio/mpeg',
             headers={
                 'Content-Disposition': 'inline; filename=speech.mp3',
-                'Cache-Control': 'no-cache'
+                'Cache-Control': 'no-cache',
+                # Permanent, cacheable URL for the same audio
+                'Content-Location': f"/audio/{tts_cache_filename(text)}"
             }
         )
         
     except ValueError as e:
-        print(f"TTS configuration error: {e}")
+        logger.error("TTS configuration error: %s", e)
         return jsonify({"error": "TTS service not configured"}), 500
     except Exception as e:
-        print(f"Error generating TTS: {e}")
+        logger.error("Error generating TTS: %s", e)
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/planet-transition", methods=["POST"])
@@ -91,7 +198,7 @@ def planet_transition():
         return jsonify({"message": message}), 200
         
     except Exception as e:
-        print(f"Error generating transition message: {e}")
+        logger.error("Error generating transition message: %s", e)
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
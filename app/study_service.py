@@ -1,21 +1,216 @@
 import os
-import json
+import orjson
 import re
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import random
+import asyncio
+import threading
+import concurrent.futures
+import hashlib
+import sqlite3
+import functools
+import contextlib
+import fcntl
+import bisect
+import collections
+import logging
 from google.api_core import exceptions
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+# Optional: semantic caching of study trees (pip install faiss-cpu sentence-transformers)
+try:
+    import faiss
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    faiss = None
+
+logger = logging.getLogger("truecopilot")
+
 # Load .env from project root
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 env_path = os.path.join(project_root, '.env')
 load_dotenv(dotenv_path=env_path)
 
-# Configure Gemini API
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
 # Using gemini-2.5-flash for better rate limits and faster responses
-model = genai.GenerativeModel('gemini-2.5-flash')
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+
+# Older google-generativeai releases have no async client; fall back to blocking calls on a thread pool
+HAS_ASYNC_CLIENT = hasattr(genai.GenerativeModel, 'generate_content_async')
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="gemini")
+
+# Client-side pacing so bursts queue locally instead of coming back as 429s (0 disables)
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', '10'))
+
+# At most this many Gemini calls are in flight on the event loop at once (0 disables)
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '6'))
+
+# Parsed Gemini results are cached on disk so repeated topics skip the API entirely
+PROMPT_CACHE_PATH = os.getenv('PROMPT_CACHE_PATH', os.path.join(project_root, 'cache', 'prompt_cache.sqlite3'))
+PROMPT_CACHE_TTL = float(os.getenv('PROMPT_CACHE_TTL_DAYS', '30')) * 24 * 60 * 60
+
+# Near-duplicate topics ("French Revolution" vs "the french revolution") reuse a cached study tree
+SEMANTIC_CACHE_ENABLED = faiss is not None and os.getenv('SEMANTIC_CACHE', '1') != '0'
+SEMANTIC_CACHE_DIR = os.getenv('SEMANTIC_CACHE_DIR', os.path.join(project_root, 'cache'))
+SEMANTIC_CACHE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+
+# Prompts are built from constant skeletons; the JSON shape of a question is shared by the question prompts
+_QUESTION_STRUCTURE = """{
+    "question": "Question text",
+    "options": ["Option A", "Option B", "Option C", "Option D"],
+    "correct_index": 0,
+    "explanation": "Brief explanation"
+}"""
+
+# Response schemas for Gemini's structured output mode
+_QUESTION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "question": {"type": "STRING"},
+        "options": {"type": "ARRAY", "items": {"type": "STRING"}, "min_items": 4, "max_items": 4},
+        "correct_index": {"type": "INTEGER"},
+        "explanation": {"type": "STRING"}
+    },
+    "required": ["question", "options", "correct_index", "explanation"]
+}
+_SUBTOPICS_SCHEMA = {"type": "ARRAY", "items": {"type": "STRING"}}
+_QUESTIONS_SCHEMA = {"type": "ARRAY", "items": _QUESTION_SCHEMA}
+_BATCHED_QUESTIONS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "results": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "subtopic": {"type": "STRING"},
+                    "questions": _QUESTIONS_SCHEMA
+                },
+                "required": ["subtopic", "questions"]
+            }
+        }
+    },
+    "required": ["results"]
+}
+_STUDY_TREE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "subtopics": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "name": {"type": "STRING"},
+                    "questions": {"type": "ARRAY", "items": _QUESTION_SCHEMA}
+                },
+                "required": ["name", "questions"]
+            }
+        }
+    },
+    "required": ["subtopics"]
+}
+
+
+def _log_success(result, request_type, request_duration):
+    """Log a successful API call, including the response length when available."""
+    logger.info("[API SUCCESS] %s - Request completed in %.2fs", request_type, request_duration)
+    
+    # Log response info if available
+    if hasattr(result, 'text'):
+        response_length = len(result.text) if result.text else 0
+        logger.info("[API SUCCESS] %s - Response length: %s characters", request_type, response_length)
+
+
+def _log_failure(e, request_type, request_duration):
+    """Log a non rate limit API failure."""
+    logger.error("[API ERROR] %s - Request failed after %.2fs", request_type, request_duration)
+    logger.error("[API ERROR] %s - Error type: %s", request_type, type(e).__name__)
+    logger.error("[API ERROR] %s - Error message: %s", request_type, str(e)[:300])
+
+
+def _server_retry_delay(e):
+    """
+    Read the server-advised retry delay from a rate limit error.
+    
+    gRPC errors carry a decoded google.rpc.RetryInfo message in e.details;
+    REST errors carry the same detail as a dict with a "retryDelay" string
+    such as "34s".
+    
+    Returns:
+        Delay in seconds, or None if the error has no RetryInfo
+    """
+    for detail in getattr(e, 'details', None) or []:
+        retry_delay = getattr(detail, 'retry_delay', None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+        if isinstance(detail, dict) and 'retryDelay' in detail:
+            return float(str(detail['retryDelay']).rstrip('s'))
+    return None
+
+
+def _rate_limit_delay(e, prev_delay, base_delay, max_delay, request_type, request_duration):
+    """
+    Log a rate limit error and work out how long to wait before retrying.
+    
+    Without a server-advised delay this uses decorrelated jitter, so
+    concurrent callers that hit the limit together do not retry in lockstep.
+    
+    Returns:
+        Delay in seconds
+    """
+    logger.warning("[API RATE LIMIT] %s - Rate limit hit after %.2fs", request_type, request_duration)
+    logger.warning("[API RATE LIMIT] %s - Error details: %s", request_type, str(e)[:200])
+    
+    suggested_delay = _server_retry_delay(e)
+    if suggested_delay is not None:
+        logger.warning("[API RATE LIMIT] %s - API suggests retry in %.1fs", request_type, suggested_delay)
+        delay = suggested_delay + random.uniform(0, 0.5)
+    else:
+        delay = random.uniform(base_delay, prev_delay * 3)
+    
+    return min(delay, max_delay)
+
+
+class RateLimiter:
+    """
+    Rolling-window request limiter shared by the worker threads and the event loop.
+    
+    Callers reserve a send time under a lock and then sleep outside it, so the
+    same limiter works for blocking calls and coroutines.
+    """
+    
+    def __init__(self, max_requests: int, window: float = 60.0):
+        self.max_requests = max_requests
+        self.window = window
+        self._send_times = collections.deque()
+        self._lock = threading.Lock()
+    
+    def reserve(self) -> float:
+        """Reserve a slot for one request and return how long to wait before sending it."""
+        if self.max_requests <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            while self._send_times and self._send_times[0] <= now - self.window:
+                self._send_times.popleft()
+            send_at = now
+            if len(self._send_times) >= self.max_requests:
+                send_at = max(now, self._send_times[-self.max_requests] + self.window)
+            bisect.insort(self._send_times, send_at)
+            return send_at - now
+    
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+_rate_limiter = RateLimiter(GEMINI_RPM)
+# Only used from the background event loop, which is the only loop the semaphore ever binds to
+_async_call_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY) if GEMINI_MAX_CONCURRENCY > 0 else contextlib.nullcontext()
 
 
 def call_with_retry(func, *args, max_retries=3, base_delay=1, max_delay=60, request_type="API", **kwargs):
@@ -27,7 +222,7 @@ def call_with_retry(func, *args, max_retries=3, base_delay=1, max_delay=60, requ
         func: Function to call
         *args: Positional arguments for func
         max_retries: Maximum number of retries
-        base_delay: Base delay in seconds for exponential backoff
+        base_delay: Minimum backoff delay in seconds
         max_delay: Maximum delay in seconds
         request_type: Type of request for logging (e.g., "Subtopics", "Questions")
         **kwargs: Keyword arguments for func
@@ -37,83 +232,426 @@ def call_with_retry(func, *args, max_retries=3, base_delay=1, max_delay=60, requ
     """
     last_exception = None
     request_start = time.time()
+    prev_delay = base_delay
     
     for attempt in range(max_retries + 1):
         try:
-            print(f"[API REQUEST] {request_type} - Attempt {attempt + 1}/{max_retries + 1}")
-            print(f"[API REQUEST] {request_type} - Making API call to Gemini...")
+            logger.debug("[API REQUEST] %s - Attempt %s/%s", request_type, attempt + 1, max_retries + 1)
+            logger.debug("[API REQUEST] %s - Making API call to Gemini...", request_type)
             
+            _rate_limiter.acquire()
             result = func(*args, **kwargs)
             
-            request_duration = time.time() - request_start
-            print(f"[API SUCCESS] {request_type} - Request completed in {request_duration:.2f}s")
-            
-            # Log response info if available
-            if hasattr(result, 'text'):
-                response_length = len(result.text) if result.text else 0
-                print(f"[API SUCCESS] {request_type} - Response length: {response_length} characters")
-            
+            _log_success(result, request_type, time.time() - request_start)
             return result
             
         except exceptions.ResourceExhausted as e:
             last_exception = e
-            request_duration = time.time() - request_start
+            delay = _rate_limit_delay(e, prev_delay, base_delay, max_delay, request_type, time.time() - request_start)
+            prev_delay = delay
             
-            # Parse rate limit details from error
-            error_str = str(e)
-            print(f"[API RATE LIMIT] {request_type} - Rate limit hit after {request_duration:.2f}s")
-            print(f"[API RATE LIMIT] {request_type} - Error details: {error_str[:200]}")
+            if attempt < max_retries:
+                logger.warning("[API RATE LIMIT] %s - Waiting %.1fs before retry (attempt %s/%s)...", request_type, delay, attempt + 1, max_retries)
+                time.sleep(delay)
+                request_start = time.time()  # Reset timer for retry
+            else:
+                logger.error("[API ERROR] %s - Max retries (%s) exceeded for rate limit", request_type, max_retries)
+                logger.error("[API ERROR] %s - Final error: %s", request_type, e)
+                raise
+                
+        except Exception as e:
+            _log_failure(e, request_type, time.time() - request_start)
+            raise
+    
+    if last_exception:
+        raise last_exception
+
+
+async def call_with_retry_async(func, *args, max_retries=3, base_delay=1, max_delay=60, request_type="API", **kwargs):
+    """
+    Async counterpart of call_with_retry for coroutine functions such as
+    model.generate_content_async. Backoff sleeps yield to the event loop
+    instead of blocking a thread.
+    
+    Args:
+        func: Coroutine function to call
+        *args: Positional arguments for func
+        max_retries: Maximum number of retries
+        base_delay: Minimum backoff delay in seconds
+        max_delay: Maximum delay in seconds
+        request_type: Type of request for logging (e.g., "Subtopics", "Questions")
+        **kwargs: Keyword arguments for func
+        
+    Returns:
+        Result of func call
+    """
+    last_exception = None
+    request_start = time.time()
+    prev_delay = base_delay
+    
+    for attempt in range(max_retries + 1):
+        try:
+            logger.debug("[API REQUEST] %s - Attempt %s/%s", request_type, attempt + 1, max_retries + 1)
+            logger.debug("[API REQUEST] %s - Making async API call to Gemini...", request_type)
+            
+            delay = _rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with _async_call_slots:
+                result = await func(*args, **kwargs)
             
-            # Try to extract quota information
-            if 'quota' in error_str.lower():
-                quota_match = re.search(r'limit:\s*(\d+)', error_str, re.IGNORECASE)
-                if quota_match:
-                    print(f"[API RATE LIMIT] {request_type} - Quota limit: {quota_match.group(1)} requests")
+            _log_success(result, request_type, time.time() - request_start)
+            return result
             
-            # Try to extract retry delay
-            delay_match = re.search(r'retry in ([\d.]+)s?', error_str, re.IGNORECASE)
-            if delay_match:
-                suggested_delay = float(delay_match.group(1))
-                print(f"[API RATE LIMIT] {request_type} - API suggests retry in {suggested_delay:.1f}s")
+        except exceptions.ResourceExhausted as e:
+            last_exception = e
+            delay = _rate_limit_delay(e, prev_delay, base_delay, max_delay, request_type, time.time() - request_start)
+            prev_delay = delay
             
             if attempt < max_retries:
-                # Extract retry delay from error if available
-                delay = base_delay * (2 ** attempt)
-                
-                if delay_match:
-                    delay = float(delay_match.group(1)) + 1  # Add 1 second buffer
-                
-                delay = min(delay, max_delay)
-                print(f"[API RATE LIMIT] {request_type} - Waiting {delay:.1f}s before retry (attempt {attempt + 1}/{max_retries})...")
-                time.sleep(delay)
+                logger.warning("[API RATE LIMIT] %s - Waiting %.1fs before retry (attempt %s/%s)...", request_type, delay, attempt + 1, max_retries)
+                await asyncio.sleep(delay)
                 request_start = time.time()  # Reset timer for retry
             else:
-                print(f"[API ERROR] {request_type} - Max retries ({max_retries}) exceeded for rate limit")
-                print(f"[API ERROR] {request_type} - Final error: {e}")
+                logger.error("[API ERROR] %s - Max retries (%s) exceeded for rate limit", request_type, max_retries)
+                logger.error("[API ERROR] %s - Final error: %s", request_type, e)
                 raise
                 
         except Exception as e:
-            request_duration = time.time() - request_start
-            print(f"[API ERROR] {request_type} - Request failed after {request_duration:.2f}s")
-            print(f"[API ERROR] {request_type} - Error type: {type(e).__name__}")
-            print(f"[API ERROR] {request_type} - Error message: {str(e)[:300]}")
+            _log_failure(e, request_type, time.time() - request_start)
             raise
     
     if last_exception:
         raise last_exception
 
 
-def get_subtopics(topic: str) -> list[str]:
+# The async Gemini client is created once and bound to the event loop it was
+# first used on, so all async calls run on one long-lived loop in a background
+# thread rather than a fresh asyncio.run() loop per request.
+_event_loop = None
+_event_loop_lock = threading.Lock()
+
+
+def _get_event_loop():
+    """Return the shared background event loop, starting it on first use."""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, name="gemini-event-loop", daemon=True).start()
+        return _event_loop
+
+
+def run_async(coro):
+    """Run a coroutine on the shared event loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+
+@functools.lru_cache(maxsize=1)
+def _configure_gemini() -> None:
+    """Configure the Gemini API key once, on first use rather than at import."""
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+
+
+@functools.lru_cache(maxsize=4)
+def get_model(name: str = GEMINI_MODEL_NAME, json_mode: bool = False):
     """
-    Generate sub topics for a given topic using Gemini API.
+    Return a cached GenerativeModel with its generation config set up once.
     
     Args:
-        topic: The main topic to study
+        name: Gemini model name
+        json_mode: Make the model respond with pure JSON (no markdown code
+            blocks), for prompts whose response is parsed
+    """
+    _configure_gemini()
+    generation_config = {"temperature": 0.7}
+    if json_mode:
+        generation_config["response_mime_type"] = "application/json"
+    return genai.GenerativeModel(name, generation_config=generation_config)
+
+
+def _structured_output_config(response_schema: dict) -> dict:
+    """Per-call generation config that makes Gemini return JSON matching response_schema."""
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+
+def generate_content(prompt: str, request_type: str = "API", json_mode: bool = False, response_schema: dict = None, **kwargs):
+    """
+    Call Gemini from synchronous code with retries.
+    
+    The call is made with the async client on the shared event loop, so every
+    request in the process reuses the same gRPC channel (one HTTP/2 keep-alive
+    connection) and the calling thread only waits on the result. Without an
+    async client the blocking call is made directly.
+    
+    Args:
+        prompt: Prompt to send
+        request_type: Type of request for logging
+        json_mode: Request a pure JSON response (see get_model)
+        response_schema: Schema the JSON response must follow (implies json_mode)
+        **kwargs: Passed to call_with_retry_async (e.g. max_retries)
         
     Returns:
-        List of sub topic strings
+        Gemini response
+    """
+    if response_schema is not None:
+        json_mode = True
+        kwargs['generation_config'] = _structured_output_config(response_schema)
+    model = get_model(json_mode=json_mode)
+    if not HAS_ASYNC_CLIENT:
+        return call_with_retry(model.generate_content, prompt, request_type=request_type, **kwargs)
+    return run_async(call_with_retry_async(model.generate_content_async, prompt, request_type=request_type, **kwargs))
+
+
+class PromptCache:
+    """
+    Persistent cache of parsed Gemini results keyed by a hash of the prompt.
+    
+    Backed by SQLite so entries survive restarts and are shared between
+    gunicorn workers. Hit and miss counts are kept per process.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # Opened lazily so each forked worker gets its own connection
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # WAL lets the other workers keep reading while one of them writes
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache "
+                "(key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def make_key(namespace: str, prompt: str) -> str:
+        return hashlib.sha256((namespace + prompt + GEMINI_MODEL_NAME).encode()).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached value for key, or None if missing or expired."""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, created_at FROM prompt_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return orjson.loads(row[0])
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO prompt_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, orjson.dumps(value), time.time())
+            )
+            conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_prompt_cache = PromptCache(PROMPT_CACHE_PATH, PROMPT_CACHE_TTL)
+
+
+def get_prompt_cache_stats() -> dict:
+    """Return prompt cache hit/miss counters for this process."""
+    return _prompt_cache.stats()
+
+
+def _cache_lookup(key: str, func_name: str):
+    try:
+        cached = _prompt_cache.get(key)
+    except sqlite3.Error as e:
+        logger.error("[CACHE ERROR] %s - Lookup failed: %s", func_name, e)
+        return None
+    if cached is not None:
+        logger.info("[CACHE HIT] %s - Skipping API call (%s)", func_name, _prompt_cache.stats())
+    return cached
+
+
+def _cache_store(key: str, func_name: str, value) -> None:
+    # Empty results mean generation failed, so don't pin them in the cache
+    if not value:
+        return
+    try:
+        _prompt_cache.set(key, value)
+    except sqlite3.Error as e:
+        logger.error("[CACHE ERROR] %s - Store failed: %s", func_name, e)
+
+
+def prompt_cache(build_prompt):
+    """
+    Cache the parsed result of a Gemini-backed function by its prompt.
+    
+    Args:
+        build_prompt: Called with the wrapped function's arguments to build
+            the prompt used as the cache key. Functions sharing a prompt
+            builder (e.g. sync and async variants) share cache entries.
+    """
+    namespace = build_prompt.__name__
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = PromptCache.make_key(namespace, build_prompt(*args, **kwargs))
+                # SQLite calls block (up to the busy timeout), so keep them off the shared event loop
+                cached = await asyncio.to_thread(_cache_lookup, key, func.__name__)
+                if cached is not None:
+                    return cached
+                result = await func(*args, **kwargs)
+                await asyncio.to_thread(_cache_store, key, func.__name__, result)
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = PromptCache.make_key(namespace, build_prompt(*args, **kwargs))
+            cached = _cache_lookup(key, func.__name__)
+            if cached is not None:
+                return cached
+            result = func(*args, **kwargs)
+            _cache_store(key, func.__name__, result)
+            return result
+        return wrapper
+    return decorator
+
+
+class SemanticCache:
     """
-    prompt = f"""Generate EXACTLY 9 specific, concrete sub topics for studying "{topic}".
+    Cache of study trees looked up by topic embedding similarity.
+    
+    Topics are embedded with a sentence-transformer and stored L2-normalized in a
+    FAISS inner product index, so the search score is the cosine similarity. A
+    cached tree is reused when a new topic scores above the threshold and was
+    generated with the same number of questions per sub topic.
+    """
+
+    def __init__(self, cache_dir: str, model_name: str, threshold: float):
+        self.index_path = os.path.join(cache_dir, 'semantic_cache.faiss')
+        self.entries_path = os.path.join(cache_dir, 'semantic_cache.json')
+        self.lock_path = os.path.join(cache_dir, 'semantic_cache.lock')
+        self.model_name = model_name
+        self.threshold = threshold
+        self._encoder = None
+        self._index = None
+        self._entries = []  # Parallel to the index: {"topic", "questions_per_subtopic", "tree"}
+        self._disk_version = None  # Version of the files _index/_entries were read from or written to
+        self._lock = threading.Lock()
+
+    def _get_encoder(self):
+        # Loaded lazily: the embedding model is slow to import and only needed once a tree is requested
+        if self._encoder is None:
+            self._encoder = SentenceTransformer(self.model_name, device='cpu')
+        return self._encoder
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive: bool):
+        """Lock the cache files against the other worker processes sharing the directory."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield  # Closing the file releases the lock
+
+    def _read_disk_version(self):
+        try:
+            st = os.stat(self.entries_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _sync(self) -> None:
+        """
+        Reload the index and entries if another process has written newer ones.
+        Must be called with the file lock held. Nothing is replaced unless both
+        files load and agree, so a failed read is simply retried next time.
+        """
+        version = self._read_disk_version()
+        if self._index is not None and version == self._disk_version:
+            return
+        dim = self._get_encoder().get_sentence_embedding_dimension()
+        index, entries = faiss.IndexFlatIP(dim), []
+        if version is not None and os.path.exists(self.index_path):
+            index = faiss.read_index(self.index_path)
+            with open(self.entries_path, 'rb') as f:
+                entries = orjson.loads(f.read())
+            if index.ntotal != len(entries) or index.d != dim:
+                raise ValueError("semantic cache index and entries on disk are out of sync")
+        self._index, self._entries, self._disk_version = index, entries, version
+
+    def _write(self) -> None:
+        """Write the index and entries atomically. Must be called with the exclusive file lock held."""
+        index_tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        entries_tmp = f"{self.entries_path}.{os.getpid()}.tmp"
+        faiss.write_index(self._index, index_tmp)
+        with open(entries_tmp, 'wb') as f:
+            f.write(orjson.dumps(self._entries))
+        os.replace(index_tmp, self.index_path)
+        os.replace(entries_tmp, self.entries_path)
+        self._disk_version = self._read_disk_version()
+
+    def _embed(self, topic: str):
+        return np.asarray(self._get_encoder().encode([topic], normalize_embeddings=True), dtype='float32')
+
+    def get(self, topic: str, questions_per_subtopic: int):
+        """Return a cached study tree for a similar topic, or None."""
+        with self._lock, self._file_lock(exclusive=False):
+            self._sync()
+            if self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(self._embed(topic), min(5, self._index.ntotal))
+            for score, idx in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                entry = self._entries[idx]
+                if entry['questions_per_subtopic'] == questions_per_subtopic:
+                    logger.info("[SEMANTIC CACHE] Hit for '%s' -> '%s' (similarity %.3f)", topic, entry['topic'], score)
+                    return entry['tree']
+        return None
+
+    def add(self, topic: str, questions_per_subtopic: int, tree: dict) -> None:
+        with self._lock, self._file_lock(exclusive=True):
+            vector = self._embed(topic)
+            # Merge with whatever the other workers have added since we last read the files
+            try:
+                self._sync()
+            except (OSError, ValueError, RuntimeError) as e:
+                logger.warning("[SEMANTIC CACHE] Cache on disk is unreadable (%s). Starting fresh.", e)
+                self._index = faiss.IndexFlatIP(vector.shape[1])
+                self._entries = []
+            self._index.add(vector)
+            self._entries.append({
+                "topic": topic,
+                "questions_per_subtopic": questions_per_subtopic,
+                "tree": tree
+            })
+            self._write()
+
+
+_semantic_cache = SemanticCache(SEMANTIC_CACHE_DIR, SEMANTIC_CACHE_MODEL, SEMANTIC_CACHE_THRESHOLD) if SEMANTIC_CACHE_ENABLED else None
+
+
+@functools.lru_cache(maxsize=256)
+def _subtopics_prompt(topic: str) -> str:
+    """
+    Build the Gemini prompt for generating the sub topics of a topic.
+    
+    Prompt builders are memoized: the prompt cache key and the API call both
+    need the prompt, so it is only formatted once per distinct set of arguments.
+    """
+    return f"""Generate EXACTLY 9 specific, concrete sub topics for studying "{topic}".
 
 Requirements:
 - Each sub topic must be SPECIFIC to "{topic}" (not generic like "Basics", "Advanced", "Introduction", "Overview")
@@ -125,121 +663,150 @@ Format: ["Sub topic 1", "Sub topic 2", "Sub topic 3", "Sub topic 4", "Sub topic
 
 Sub topics for "{topic}":"""
 
-    try:
-        response = call_with_retry(model.generate_content, prompt, request_type="Subtopics")
-        text = response.text.strip()
-        print(f"[API RESPONSE] Subtopics - Raw response preview: {text[:100]}...")
-        
-        # Improved JSON extraction - similar to generate_questions
-        if text.startswith('```'):
-            parts = text.split('```')
-            for part in parts:
-                part = part.strip()
-                if part.startswith('json'):
-                    text = part[4:].strip()
-                    break
-                elif part.startswith('['):
-                    text = part
-                    break
-        else:
-            # Try to find JSON array in the text
-            json_match = re.search(r'\[.*\]', text, re.DOTALL)
-            if json_match:
-                text = json_match.group(0)
+
+# Words and phrases that mark a short sub topic as generic ("Basics", "Introduction", "General Concepts", ...)
+_GENERIC_WORDS = frozenset({"basics", "basic", "advanced", "introduction", "intro", "overview", "application", "applications"})
+_GENERIC_RE = re.compile(r'\bgeneral concepts?\b')
+_WORD_RE = re.compile(r'\w+')
+
+
+def _select_subtopics(subtopics: list) -> list[str]:
+    """
+    Pick up to 9 sub topics, dropping generic ones (e.g. "{topic} Basics").
+    Generic sub topics are only used to pad the list back up to 9.
+    
+    Args:
+        subtopics: Sub topics returned by Gemini
         
-        text = text.strip()
+    Returns:
+        List of at most 9 sub topic strings
+    """
+    # Repeated sub topics would send identical question prompts; keep the first spelling of each
+    unique = {}
+    for st in subtopics:
+        st_str = str(st).strip()
+        if st_str:
+            unique.setdefault(st_str.lower(), st_str)
+    subtopics = list(unique.values())
+
+    # Filter out generic subtopics
+    filtered = []
+    for st in subtopics:
+        st_str = str(st).strip()
+        st_lower = st_str.lower()
+    
+        # If it's just "{topic} Basics" or similar, it's generic
+        # But allow longer phrases like "Advanced Machine Learning Techniques"
+        # Length counts whitespace words ("Object-Oriented" is one); matching uses \w+ so punctuation can't hide a generic word
+        is_generic = len(st_lower.split()) <= 3 and bool(
+            _GENERIC_WORDS.intersection(_WORD_RE.findall(st_lower)) or _GENERIC_RE.search(st_lower)
+        )
+    
+        if not is_generic:
+            filtered.append(st_str)
+    
+    # We need exactly 9 subtopics for 9 planets
+    if len(filtered) >= 9:
+        logger.info("Successfully generated %s specific sub topics: %s", len(filtered), filtered[:9])
+        return filtered[:9]  # Take first 9
+    elif len(filtered) > 0:
+        # If we have some but not 9, pad with originals or request more
+        logger.warning("Only %s sub topics passed filtering. Using available: %s", len(filtered), filtered)
+        # Try to fill from original list if needed
+        remaining = [str(st) for st in subtopics if str(st).strip() not in filtered]
+        while len(filtered) < 9 and remaining:
+            filtered.append(remaining.pop(0))
+        return filtered[:9] if len(filtered) >= 9 else filtered
+    else:
+        logger.warning("All sub topics were filtered as generic. Using original list: %s", subtopics)
+        return [str(st) for st in subtopics][:9]
+
+
+@prompt_cache(_subtopics_prompt)
+def get_subtopics(topic: str) -> list[str]:
+    """
+    Generate sub topics for a given topic using Gemini API.
+    
+    Args:
+        topic: The main topic to study
         
-        # Remove any leading/trailing non-JSON characters
-        if not text.startswith('['):
-            # Try to find the array
-            start_idx = text.find('[')
-            end_idx = text.rfind(']')
-            if start_idx != -1 and end_idx != -1 and end_idx > start_idx:
-                text = text[start_idx:end_idx+1]
+    Returns:
+        List of sub topic strings
+    """
+    prompt = _subtopics_prompt(topic)
+
+    try:
+        response = generate_content(prompt, request_type="Subtopics", response_schema=_SUBTOPICS_SCHEMA)
+        text = response.text
+        logger.info("[API RESPONSE] Subtopics - Raw response preview: %s...", text[:100])
         
         # Parse JSON
-        subtopics = json.loads(text)
+        subtopics = orjson.loads(text)
         if isinstance(subtopics, list) and len(subtopics) > 0:
-            # Filter out generic subtopics
-            filtered = []
-            generic_patterns = [
-                r'\b(basics?|basic)\b',
-                r'\b(advanced|advanced concepts?)\b',
-                r'\b(introduction|intro)\b',
-                r'\b(overview)\b',
-                r'\b(applications?)\b',
-                r'\b(general concepts?)\b'
-            ]
-            
-            for st in subtopics:
-                st_str = str(st).strip()
-                st_lower = st_str.lower()
-                
-                # Check if it matches generic patterns
-                is_generic = False
-                for pattern in generic_patterns:
-                    if re.search(pattern, st_lower):
-                        # If it's just "{topic} Basics" or similar, it's generic
-                        # But allow longer phrases like "Advanced Machine Learning Techniques"
-                        words = st_lower.split()
-                        if len(words) <= 3 and any(re.search(pattern, word) for word in words):
-                            is_generic = True
-                            break
-                
-                # Also check if it's too generic (just topic name + generic word)
-                if not is_generic:
-                    topic_lower = topic.lower()
-                    if st_lower.startswith(topic_lower) and len(st_lower.split()) <= 3:
-                        # Might be generic, check further
-                        remaining = st_lower[len(topic_lower):].strip()
-                        if remaining in ['basics', 'basic', 'advanced', 'introduction', 'overview', 'applications']:
-                            is_generic = True
-                
-                if not is_generic:
-                    filtered.append(st_str)
-            
-            # We need exactly 9 subtopics for 9 planets
-            if len(filtered) >= 9:
-                print(f"Successfully generated {len(filtered)} specific sub topics: {filtered[:9]}")
-                return filtered[:9]  # Take first 9
-            elif len(filtered) > 0:
-                # If we have some but not 9, pad with originals or request more
-                print(f"Warning: Only {len(filtered)} sub topics passed filtering. Using available: {filtered}")
-                # Try to fill from original list if needed
-                remaining = [str(st) for st in subtopics if str(st).strip() not in filtered]
-                while len(filtered) < 9 and remaining:
-                    filtered.append(remaining.pop(0))
-                return filtered[:9] if len(filtered) >= 9 else filtered
-            else:
-                print(f"Warning: All sub topics were filtered as generic. Using original list: {subtopics}")
-                return [str(st) for st in subtopics][:9]
+            return _select_subtopics(subtopics)
         else:
-            print(f"Warning: Invalid response format. Got: {text[:200]}")
+            logger.warning("Invalid response format. Got: %s", text[:200])
             return []
-    except json.JSONDecodeError as e:
-        print(f"JSON decode error generating sub topics: {e}")
-        print(f"Response text: {text[:500] if 'text' in locals() else 'N/A'}")
-        # Try one more time with a simpler prompt
-        try:
-            retry_prompt = f'Return a JSON array of 5 specific sub topics for "{topic}". Example: ["Topic 1", "Topic 2", "Topic 3", "Topic 4", "Topic 5"]'
-            retry_response = call_with_retry(model.generate_content, retry_prompt, max_retries=2, request_type="Subtopics-Retry")
-            retry_text = retry_response.text.strip()
-            # Extract JSON
-            json_match = re.search(r'\[.*\]', retry_text, re.DOTALL)
-            if json_match:
-                retry_text = json_match.group(0)
-            subtopics = json.loads(retry_text)
-            if isinstance(subtopics, list) and len(subtopics) > 0:
-                return [str(st) for st in subtopics]
-        except:
-            pass
+    except orjson.JSONDecodeError as e:
+        logger.error("JSON decode error generating sub topics: %s", e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
         return []
     except Exception as e:
-        print(f"Error generating sub topics: {e}")
-        print(f"Response text: {text[:500] if 'text' in locals() else 'N/A'}")
+        logger.error("Error generating sub topics: %s", e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
         return []
 
 
+@functools.lru_cache(maxsize=256)
+def _questions_prompt(subtopic: str, topic: str, num_questions: int = 3) -> str:
+    """Build the Gemini prompt for generating questions about a sub topic."""
+    return f"""Generate {num_questions} multiple choice questions about "{subtopic}" (topic: "{topic}").
+
+Return ONLY a JSON array. Each question structure:
+{_QUESTION_STRUCTURE}
+
+Questions for "{subtopic}":"""
+
+
+def _validate_questions(questions) -> list[dict]:
+    """
+    Drop questions the client can't use. The response schema already makes
+    Gemini return exactly the four required fields, so nothing is patched with
+    defaults; a question missing a field, with a field of the wrong type, without
+    four string options or with an out of range correct_index is discarded on
+    its own, without failing the rest of the response.
+    """
+    if not isinstance(questions, list):
+        return []
+    return [
+        q for q in questions
+        if isinstance(q, dict)
+        and isinstance(q.get('question'), str)
+        and isinstance(q.get('explanation'), str)
+        and isinstance(q.get('options'), list) and len(q['options']) == 4
+        and all(isinstance(option, str) for option in q['options'])
+        and type(q.get('correct_index')) is int and 0 <= q['correct_index'] < 4
+    ]
+
+
+def _parse_questions(text: str, subtopic: str) -> list[dict]:
+    """
+    Parse and validate the questions returned by Gemini for a sub topic.
+    
+    Args:
+        text: Raw response text
+        subtopic: The sub topic the questions belong to (for logging)
+        
+    Returns:
+        List of validated question dictionaries
+    """
+    logger.info("[API RESPONSE] Questions for '%s' - Raw response preview: %s...", subtopic, text.strip()[:100])
+    return _validate_questions(orjson.loads(text))
+
+
+@prompt_cache(_questions_prompt)
 def generate_questions(subtopic: str, topic: str, num_questions: int = 3) -> list[dict]:
     """
     Generate multiple choice questions for a sub topic.
@@ -258,64 +825,292 @@ def generate_questions(subtopic: str, topic: str, num_questions: int = 3) -> lis
             "explanation": str
         }
     """
-    prompt = f"""Generate {num_questions} multiple choice questions about "{subtopic}" (topic: "{topic}").
+    prompt = _questions_prompt(subtopic, topic, num_questions)
 
-Return ONLY a JSON array. Each question structure:
+    try:
+        response = generate_content(prompt, request_type=f"Questions-{subtopic[:30]}", response_schema=_QUESTIONS_SCHEMA)
+        text = response.text
+        return _parse_questions(text, subtopic)
+    except Exception as e:
+        logger.error("Error generating questions for %s: %s", subtopic, e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
+        return []
+
+
+@prompt_cache(_questions_prompt)
+async def generate_questions_async(subtopic: str, topic: str, num_questions: int = 3) -> list[dict]:
+    """
+    Async version of generate_questions using Gemini's non-blocking client,
+    so questions for several sub topics can be requested concurrently.
+    
+    Args:
+        subtopic: The sub topic to generate questions for
+        topic: The main topic (for context)
+        num_questions: Number of questions to generate (default: 3)
+        
+    Returns:
+        List of question dictionaries (see generate_questions)
+    """
+    prompt = _questions_prompt(subtopic, topic, num_questions)
+
+    try:
+        response = await call_with_retry_async(
+            get_model(json_mode=True).generate_content_async, prompt,
+            request_type=f"Questions-{subtopic[:30]}", generation_config=_structured_output_config(_QUESTIONS_SCHEMA)
+        )
+        text = response.text
+        return _parse_questions(text, subtopic)
+    except Exception as e:
+        logger.error("Error generating questions for %s: %s", subtopic, e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
+        return []
+
+
+def _batched_questions_prompt(subtopics: list[str], topic: str, num_questions: int = 3) -> str:
+    """Build a single Gemini prompt that asks for questions for every sub topic at once."""
+    numbered_subtopics = "\n".join(f"{i}. {subtopic}" for i, subtopic in enumerate(subtopics, 1))
+    return f"""For each of the following sub topics of "{topic}", generate {num_questions} multiple choice questions.
+
+Sub topics:
+{numbered_subtopics}
+
+Return ONLY a JSON object with one result per sub topic, in the same order, with the sub topic spelled exactly as given. Each question structure:
+{_QUESTION_STRUCTURE}
+
+Format: {{"results": [{{"subtopic": "Sub topic 1", "questions": [question, ...]}}, ...]}}"""
+
+
+@prompt_cache(_batched_questions_prompt)
+def generate_questions_batched(subtopics: list[str], topic: str, num_questions: int = 3) -> dict[str, list[dict]]:
+    """
+    Generate questions for several sub topics with a single Gemini call.
+    
+    Sharing one prompt amortizes the instructions across all sub topics and
+    replaces N round trips with one.
+    
+    Args:
+        subtopics: The sub topics to generate questions for
+        topic: The main topic (for context)
+        num_questions: Number of questions to generate per sub topic
+        
+    Returns:
+        Dictionary mapping sub topics to their validated questions. Sub topics
+        the response left out (or gave no valid questions for) are missing, so
+        the caller can generate just those individually. Empty if the response
+        could not be parsed.
+    """
+    prompt = _batched_questions_prompt(subtopics, topic, num_questions)
+
+    try:
+        response = generate_content(prompt, request_type=f"Questions-Batched-{len(subtopics)}", response_schema=_BATCHED_QUESTIONS_SCHEMA)
+        text = response.text
+        logger.info("[API RESPONSE] Batched questions - Raw response preview: %s...", text.strip()[:100])
+        
+        parsed = orjson.loads(text)
+        results = parsed.get('results') if isinstance(parsed, dict) else None
+        if not isinstance(results, list):
+            logger.warning("Batched questions response has no results list. Got: %s", text[:200])
+            return {}
+        
+        # Index results by name, tolerating case and whitespace differences
+        questions_by_name = {}
+        for result in results:
+            if isinstance(result, dict) and result.get('subtopic'):
+                questions = _validate_questions(result.get('questions'))
+                if questions:
+                    questions_by_name[str(result['subtopic']).strip().lower()] = questions
+        
+        questions_by_subtopic = {
+            subtopic: questions_by_name[subtopic.strip().lower()]
+            for subtopic in subtopics
+            if subtopic.strip().lower() in questions_by_name
+        }
+        if len(questions_by_subtopic) < len(subtopics):
+            missing = [subtopic for subtopic in subtopics if subtopic not in questions_by_subtopic]
+            logger.warning("Batched questions response is missing sub topics: %s", missing)
+        return questions_by_subtopic
+    except Exception as e:
+        logger.error("Error generating batched questions: %s", e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
+        return {}
+
+
+async def _generate_all_questions(subtopics: list[str], topic: str, num_questions: int) -> list[dict]:
+    """
+    Generate questions for every sub topic concurrently.
+    
+    Returns:
+        List of {"name": str, "questions": [...]} in the same order as subtopics
+    """
+    tasks = [generate_questions_async(subtopic, topic, num_questions) for subtopic in subtopics]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    
+    subtopics_with_questions = []
+    for subtopic, questions in zip(subtopics, results):
+        if isinstance(questions, BaseException):
+            logger.error("✗ [API ERROR] Error generating questions for '%s': %s: %s", subtopic, type(questions).__name__, questions)
+            questions = []
+        else:
+            logger.info("✓ Completed: '%s' - %s questions", subtopic, len(questions))
+        subtopics_with_questions.append({
+            "name": subtopic,
+            "questions": questions
+        })
+    return subtopics_with_questions
+
+
+def _submit_question_generation(subtopic: str, topic: str, num_questions: int) -> concurrent.futures.Future:
+    """Start generating questions for a sub topic in the background."""
+    if HAS_ASYNC_CLIENT:
+        return asyncio.run_coroutine_threadsafe(
+            generate_questions_async(subtopic, topic, num_questions), _get_event_loop()
+        )
+    return _executor.submit(generate_questions, subtopic, topic, num_questions)
+
+
+def _generate_all_questions_threaded(subtopics: list[str], topic: str, num_questions: int) -> list[dict]:
+    """
+    Generate questions for every sub topic concurrently on the thread pool.
+    Used when the async client isn't available; the GIL is released while
+    threads wait on the network, so this still overlaps the API calls.
+    
+    Returns:
+        List of {"name": str, "questions": [...]} in the same order as subtopics
+    """
+    futures = [_executor.submit(generate_questions, subtopic, topic, num_questions) for subtopic in subtopics]
+    
+    subtopics_with_questions = []
+    for subtopic, future in zip(subtopics, futures):
+        try:
+            questions = future.result()
+            logger.info("✓ Completed: '%s' - %s questions", subtopic, len(questions))
+        except Exception as e:
+            logger.error("✗ [API ERROR] Error generating questions for '%s': %s: %s", subtopic, type(e).__name__, e)
+            questions = []
+        subtopics_with_questions.append({
+            "name": subtopic,
+            "questions": questions
+        })
+    return subtopics_with_questions
+
+
+@functools.lru_cache(maxsize=256)
+def _study_tree_prompt(topic: str, num_questions: int = 3) -> str:
+    """Build a single Gemini prompt for the sub topics and their questions."""
+    return f"""Generate EXACTLY 9 specific, concrete sub topics for studying "{topic}", and {num_questions} multiple choice questions for each sub topic.
+
+Requirements:
+- Each sub topic must be SPECIFIC to "{topic}" (not generic like "Basics", "Advanced", "Introduction", "Overview")
+- Each sub topic should be a distinct, important area or concept within "{topic}"
+- Return EXACTLY 9 sub topics (one for each planet)
+
+Return ONLY a valid JSON object. No other text, no markdown. Structure:
 {{
-    "question": "Question text",
-    "options": ["Option A", "Option B", "Option C", "Option D"],
-    "correct_index": 0,
-    "explanation": "Brief explanation"
-}}
+    "subtopics": [
+        {{
+            "name": "Sub topic 1",
+            "questions": [
+                {{
+                    "question": "Question text",
+                    "options": ["Option A", "Option B", "Option C", "Option D"],
+                    "correct_index": 0,
+                    "explanation": "Brief explanation"
+                }}
+            ]
+        }}
+    ]
+}}"""
 
-Questions for "{subtopic}":"""
+
+@prompt_cache(_study_tree_prompt)
+def create_study_tree_single_shot(topic: str, questions_per_subtopic: int = 3) -> dict:
+    """
+    Generate the sub topics and their questions with a single Gemini call.
+    
+    This removes the round trip where question generation waits on the
+    sub topic list. The response is constrained to _STUDY_TREE_SCHEMA.
+    
+    Args:
+        topic: The main topic to study
+        questions_per_subtopic: Number of questions to generate per sub topic
+        
+    Returns:
+        Study tree dictionary (see create_study_tree), or an empty dictionary
+        if the response doesn't match the schema or doesn't contain 9 sub
+        topics with questions
+    """
+    prompt = _study_tree_prompt(topic, questions_per_subtopic)
 
     try:
-        response = call_with_retry(model.generate_content, prompt, request_type=f"Questions-{subtopic[:30]}")
-        text = response.text.strip()
-        print(f"[API RESPONSE] Questions for '{subtopic}' - Raw response preview: {text[:100]}...")
+        response = generate_content(prompt, request_type="StudyTree", response_schema=_STUDY_TREE_SCHEMA)
+        text = response.text
+        logger.info("[API RESPONSE] Study tree - Raw response preview: %s...", text.strip()[:100])
         
-        # Clean up the response - remove markdown code blocks if present
-        if text.startswith('```'):
-            parts = text.split('```')
-            for part in parts:
-                if part.strip().startswith('json') or part.strip().startswith('{') or part.strip().startswith('['):
-                    text = part.strip()
-                    if text.startswith('json'):
-                        text = text[4:].strip()
-                    break
+        parsed = orjson.loads(text)
+        subtopics = parsed.get('subtopics') if isinstance(parsed, dict) else None
+        if not isinstance(subtopics, list):
+            logger.warning("Invalid study tree format. Got: %s", text[:200])
+            return {}
         
-        text = text.strip()
+        questions_by_name = {}
+        for st in subtopics:
+            if isinstance(st, dict) and st.get('name'):
+                questions = _validate_questions(st.get('questions'))
+                if questions:
+                    questions_by_name.setdefault(str(st['name']).strip(), questions)
+        if not questions_by_name:
+            logger.warning("Study tree has no usable sub topics")
+            return {}
         
-        # Parse JSON
-        questions = json.loads(text)
-        if isinstance(questions, list):
-            # Validate and clean questions
-            validated_questions = []
-            for q in questions:
-                if isinstance(q, dict) and 'question' in q and 'options' in q:
-                    # Ensure correct_index is valid
-                    if 'correct_index' not in q or not isinstance(q['correct_index'], int):
-                        q['correct_index'] = 0
-                    if q['correct_index'] < 0 or q['correct_index'] >= len(q.get('options', [])):
-                        q['correct_index'] = 0
-                    if 'explanation' not in q:
-                        q['explanation'] = "This is the correct answer."
-                    validated_questions.append(q)
-            return validated_questions
-        return []
+        # Same generic sub topic filter as the two-stage path
+        names = _select_subtopics(list(questions_by_name))
+        if len(names) < 9:
+            logger.warning("Study tree has %s usable sub topics, expected 9", len(names))
+            return {}
+        
+        return {
+            "topic": topic,
+            "subtopics": [{"name": name, "questions": questions_by_name[name]} for name in names]
+        }
     except Exception as e:
-        print(f"Error generating questions for {subtopic}: {e}")
-        print(f"Response text: {text[:500] if 'text' in locals() else 'N/A'}")
-        return []
+        logger.error("Error generating study tree: %s", e)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response text: %s", text[:500] if 'text' in locals() else 'N/A')
+        return {}
+
+
+def _log_summary(start_time: float, total_api_calls: int) -> None:
+    """Log timing stats for a completed study tree generation."""
+    elapsed_time = time.time() - start_time
+    logger.info("========================================")
+    logger.info("✓ Study tree generation complete!")
+    logger.info("  Total time: %.1f seconds", elapsed_time)
+    logger.info("  Total API calls made: %s", total_api_calls)
+    logger.info("  Average time per API call: %.2fs", elapsed_time/total_api_calls)
+    logger.info("========================================")
+
+
+def _is_complete_tree(subtopics: list[dict]) -> bool:
+    """
+    Whether every sub topic got its questions. Semantic cache entries never
+    expire, and empty questions mean a call failed, so incomplete trees aren't cached.
+    """
+    return bool(subtopics) and all(st["questions"] for st in subtopics)
 
 
 def create_study_tree(topic: str, questions_per_subtopic: int = 3) -> dict:
     """
     Create a complete study tree structure for a topic.
     
-    Uses parallel processing to generate questions for multiple subtopics simultaneously,
-    which significantly speeds up the generation process.
+    The sub topics and their questions are requested with a single call. If that
+    response can't be used, sub topics are generated first and their questions
+    requested in one batched call. Any sub topics that call misses are then
+    requested concurrently with asyncio.gather, one call per sub topic. When the
+    optional semantic cache is available, a tree generated for a near-identical
+    topic is returned without calling the API.
     
     Args:
         topic: The main topic to study
@@ -340,77 +1135,81 @@ def create_study_tree(topic: str, questions_per_subtopic: int = 3) -> dict:
             ]
         }
     """
+    if _semantic_cache is not None:
+        try:
+            cached_tree = _semantic_cache.get(topic, questions_per_subtopic)
+            if cached_tree is not None:
+                return {**cached_tree, "topic": topic}
+        except Exception as e:
+            logger.error("[SEMANTIC CACHE ERROR] Lookup failed: %s: %s", type(e).__name__, e)
+    
+    study_tree = _build_study_tree(topic, questions_per_subtopic)
+    
+    if _semantic_cache is not None and _is_complete_tree(study_tree["subtopics"]):
+        try:
+            _semantic_cache.add(topic, questions_per_subtopic, study_tree)
+        except Exception as e:
+            logger.error("[SEMANTIC CACHE ERROR] Store failed: %s: %s", type(e).__name__, e)
+    
+    return study_tree
+
+
+def _build_study_tree(topic: str, questions_per_subtopic: int) -> dict:
+    """Generate a study tree with Gemini (see create_study_tree)."""
     start_time = time.time()
-    print(f"[{time.strftime('%H:%M:%S')}] Starting study tree generation for topic: '{topic}'")
+    logger.info("Starting study tree generation for topic: '%s'", topic)
+    
+    # Fast path: sub topics and questions from one call
+    study_tree = create_study_tree_single_shot(topic, questions_per_subtopic)
+    if study_tree:
+        _log_summary(start_time, 1)
+        return study_tree
+    
+    # Fall back to generating sub topics first, then their questions
+    logger.warning("⚠ Single-shot generation failed. Falling back to two-stage generation...")
+    total_api_calls = 1
     
     # Step 1: Get sub topics (exactly 9 for 9 planets)
-    print(f"[{time.strftime('%H:%M:%S')}] Step 1/2: Generating 9 subtopics (one per planet)...")
+    logger.info("Step 1/2: Generating 9 subtopics (one per planet)...")
     subtopics_list = get_subtopics(topic)
     # Ensure we have exactly 9
     if len(subtopics_list) < 9:
-        print(f"[{time.strftime('%H:%M:%S')}] ⚠ Warning: Only {len(subtopics_list)} subtopics generated, expected 9")
+        logger.warning("⚠ Only %s subtopics generated, expected 9", len(subtopics_list))
     elif len(subtopics_list) > 9:
         subtopics_list = subtopics_list[:9]
-        print(f"[{time.strftime('%H:%M:%S')}] ✓ Using first 9 subtopics")
+        logger.info("✓ Using first 9 subtopics")
     else:
-        print(f"[{time.strftime('%H:%M:%S')}] ✓ Generated exactly 9 subtopics")
+        logger.info("✓ Generated exactly 9 subtopics")
     
     if not subtopics_list:
-        print(f"[{time.strftime('%H:%M:%S')}] ⚠ No subtopics generated. Returning empty tree.")
+        logger.warning("⚠ No subtopics generated. Returning empty tree.")
         return {
             "topic": topic,
             "subtopics": []
         }
     
-    # Step 2: Generate questions for each sub topic in parallel
-    print(f"[{time.strftime('%H:%M:%S')}] Step 2/2: Generating questions for {len(subtopics_list)} subtopics (parallel)...")
-    print(f"[{time.strftime('%H:%M:%S')}] [API] Will make {len(subtopics_list)} parallel API calls (max 6 concurrent)...")
-    
-    # Create a list to store results in order
-    subtopics_with_questions = [None] * len(subtopics_list)
-    
-    # Use ThreadPoolExecutor to generate questions in parallel
-    # Limit to 6 concurrent requests to maximize parallelism
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        print(f"[{time.strftime('%H:%M:%S')}] [API] ThreadPoolExecutor initialized with max_workers=6")
-        # Submit all tasks
-        future_to_subtopic = {
-            executor.submit(generate_questions, subtopic, topic, questions_per_subtopic): (original_idx, subtopic)
-            for original_idx, subtopic in enumerate(subtopics_list)
-        }
-        
-        # Process completed tasks as they finish
-        completed = 0
-        for future in as_completed(future_to_subtopic):
-            original_idx, subtopic = future_to_subtopic[future]
-            completed += 1
-            
-            try:
-                print(f"[{time.strftime('%H:%M:%S')}] [API] Processing completed request {completed}/{len(subtopics_list)} for: '{subtopic}'")
-                questions = future.result()
-                subtopics_with_questions[original_idx] = {
-                    "name": subtopic,
-                    "questions": questions
-                }
-                print(f"[{time.strftime('%H:%M:%S')}] ✓ ({completed}/{len(subtopics_list)}) Completed: '{subtopic}' - {len(questions)} questions")
-            except Exception as e:
-                print(f"[{time.strftime('%H:%M:%S')}] ✗ [API ERROR] Error generating questions for '{subtopic}': {type(e).__name__}: {e}")
-                subtopics_with_questions[original_idx] = {
-                    "name": subtopic,
-                    "questions": []
-                }
+    # Step 2: Generate questions for all sub topics in one batched call
+    logger.info("Step 2/2: Generating questions for %s subtopics (batched)...", len(subtopics_list))
+    total_api_calls += 2
+    questions_by_subtopic = generate_questions_batched(subtopics_list, topic, questions_per_subtopic)
     
-    # Filter out None values (shouldn't happen, but safety check)
-    subtopics_with_questions = [st for st in subtopics_with_questions if st is not None]
+    # Generate whatever the batched call didn't cover with one concurrent call per sub topic
+    missing = [subtopic for subtopic in subtopics_list if subtopic not in questions_by_subtopic]
+    if missing:
+        logger.warning("⚠ Batched generation missed %s/%s subtopics. Falling back to %s concurrent API calls...", len(missing), len(subtopics_list), len(missing))
+        total_api_calls += len(missing)
+        if HAS_ASYNC_CLIENT:
+            fallback = run_async(_generate_all_questions(missing, topic, questions_per_subtopic))
+        else:
+            fallback = _generate_all_questions_threaded(missing, topic, questions_per_subtopic)
+        questions_by_subtopic = {**questions_by_subtopic, **{st["name"]: st["questions"] for st in fallback}}
     
-    elapsed_time = time.time() - start_time
-    total_api_calls = 1 + len(subtopics_list)  # 1 for subtopics + 1 per subtopic for questions
-    print(f"[{time.strftime('%H:%M:%S')}] ========================================")
-    print(f"[{time.strftime('%H:%M:%S')}] ✓ Study tree generation complete!")
-    print(f"[{time.strftime('%H:%M:%S')}]   Total time: {elapsed_time:.1f} seconds")
-    print(f"[{time.strftime('%H:%M:%S')}]   Total API calls made: {total_api_calls}")
-    print(f"[{time.strftime('%H:%M:%S')}]   Average time per API call: {elapsed_time/total_api_calls:.2f}s")
-    print(f"[{time.strftime('%H:%M:%S')}] ========================================")
+    subtopics_with_questions = [
+        {"name": subtopic, "questions": questions_by_subtopic[subtopic]}
+        for subtopic in subtopics_list
+    ]
+    
+    _log_summary(start_time, total_api_calls)
     
     return {
         "topic": topic,
@@ -418,6 +1217,97 @@ def create_study_tree(topic: str, questions_per_subtopic: int = 3) -> dict:
     }
 
 
+def warm_cache(topics: list[str], questions_per_subtopic: int = 3) -> None:
+    """
+    Generate study trees for the given topics so they're already cached.
+    
+    Runs the normal create_study_tree path, filling the prompt cache (and the
+    semantic cache when enabled). Topics that are already cached cost nothing.
+    
+    The caches are shared by every gunicorn worker, so only the worker that
+    gets the warm lock does the work; the others skip rather than making the
+    same API calls at the same time.
+    """
+    lock_path = os.path.join(os.path.dirname(PROMPT_CACHE_PATH), 'warm_cache.lock')
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("[CACHE WARM] Another worker is already warming the cache. Skipping.")
+            return
+        
+        logger.info("[CACHE WARM] Warming cache for %s topics...", len(topics))
+        for topic in topics:
+            try:
+                create_study_tree(topic, questions_per_subtopic)
+            except Exception as e:
+                logger.error("[CACHE WARM] Failed to warm '%s': %s: %s", topic, type(e).__name__, e)
+        logger.info("[CACHE WARM] Done. Prompt cache stats: %s", _prompt_cache.stats())
+
+
+def stream_study_tree(topic: str, questions_per_subtopic: int = 3):
+    """
+    Generate a study tree incrementally as newline-delimited JSON.
+    
+    The first line is {"topic": str, "subtopics": [str, ...]}. Each following
+    line is {"index": int, "name": str, "questions": [...]} for one sub topic,
+    yielded as soon as its questions are ready (completion order, not list
+    order), so clients can render planets before the whole tree is done.
+    
+    Args:
+        topic: The main topic to study
+        questions_per_subtopic: Number of questions to generate per sub topic
+        
+    Yields:
+        Encoded JSON lines (bytes)
+    """
+    if _semantic_cache is not None:
+        try:
+            cached_tree = _semantic_cache.get(topic, questions_per_subtopic)
+        except Exception as e:
+            logger.error("[SEMANTIC CACHE ERROR] Lookup failed: %s: %s", type(e).__name__, e)
+            cached_tree = None
+        if cached_tree is not None:
+            yield orjson.dumps({"topic": topic, "subtopics": [st["name"] for st in cached_tree["subtopics"]]}) + b"\n"
+            for index, subtopic in enumerate(cached_tree["subtopics"]):
+                yield orjson.dumps({"index": index, **subtopic}) + b"\n"
+            return
+    
+    subtopics_list = get_subtopics(topic)[:9]
+    yield orjson.dumps({"topic": topic, "subtopics": subtopics_list}) + b"\n"
+    if not subtopics_list:
+        return
+    
+    # Sub topic names are unique (see _select_subtopics), so results can be keyed by name
+    future_to_subtopic = {
+        _submit_question_generation(subtopic, topic, questions_per_subtopic): subtopic
+        for subtopic in subtopics_list
+    }
+    results: dict[str, list] = {}
+    
+    try:
+        for future in concurrent.futures.as_completed(future_to_subtopic):
+            subtopic = future_to_subtopic[future]
+            try:
+                results[subtopic] = future.result() or []
+            except Exception as e:
+                logger.error("✗ [API ERROR] Error generating questions for '%s': %s: %s", subtopic, type(e).__name__, e)
+                results[subtopic] = []
+            yield orjson.dumps({"index": subtopics_list.index(subtopic), "name": subtopic, "questions": results[subtopic]}) + b"\n"
+    finally:
+        # Client went away mid-stream: don't keep generating questions nobody will read
+        for future in future_to_subtopic:
+            future.cancel()
+    
+    subtopics_with_questions = [{"name": subtopic, "questions": results.get(subtopic, [])} for subtopic in subtopics_list]
+    if _semantic_cache is not None and _is_complete_tree(subtopics_with_questions):
+        try:
+            _semantic_cache.add(topic, questions_per_subtopic, {"topic": topic, "subtopics": subtopics_with_questions})
+        except Exception as e:
+            logger.error("[SEMANTIC CACHE ERROR] Store failed: %s: %s", type(e).__name__, e)
+
+
 def generate_planet_transition_message(topic: str, from_planet: str, to_planet: str, from_subtopic: str, to_subtopic: str) -> str:
     """
     Generate a quirky, fun transition message between planets related to the topic.
@@ -452,7 +1342,7 @@ Example style: "Blasting off from {from_planet}! Time to explore {to_planet} and
 Transition message:"""
 
     try:
-        response = call_with_retry(model.generate_content, prompt, request_type="PlanetTransition", max_retries=2)
+        response = generate_content(prompt, request_type="PlanetTransition", max_retries=2)
         text = response.text.strip()
         
         # Clean up the response - remove quotes if present
@@ -467,7 +1357,7 @@ Transition message:"""
         
         return text
     except Exception as e:
-        print(f"Error generating transition message: {e}")
+        logger.error("Error generating transition message: %s", e)
         # Fallback message
         return f"Traveling from {from_planet} to {to_planet}. Let's continue studying {topic}!"
 
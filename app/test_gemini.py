@@ -4,7 +4,7 @@ Test script to debug Gemini API queries for subtopic generation.
 """
 
 import os
-import json
+import orjson
 import re
 import google.generativeai as genai
 from dotenv import load_dotenv
@@ -135,7 +135,7 @@ Sub topics for "{topic}":"""
         
         # Try to parse
         try:
-            subtopics = json.loads(text)
+            subtopics = orjson.loads(text)
             print(f"\n✅ SUCCESS! Parsed JSON:")
             print(f"   Type: {type(subtopics)}")
             print(f"   Length: {len(subtopics) if isinstance(subtopics, list) else 'N/A'}")
@@ -150,7 +150,7 @@ Sub topics for "{topic}":"""
                 print(f"\n❌ ERROR: Response is not a list!")
                 return []
                 
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             print(f"\n❌ JSON DECODE ERROR:")
             print(f"   Error: {e}")
             print(f"   Text that failed: {repr(text)}")
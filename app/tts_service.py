@@ -1,17 +1,46 @@
 import os
+import hashlib
+import logging
+import threading
+import time
+from typing import Iterator
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
+logger = logging.getLogger("truecopilot")
+
 # Load .env from project root
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 env_path = os.path.join(project_root, '.env')
 load_dotenv(dotenv_path=env_path)
 
-ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
 # Using a free tier compatible voice ID
 # Rachel - clear, friendly female voice (free tier compatible)
 ELEVENLABS_VOICE_ID = "21m00Tcm4TlvDq8ikWAM"
 ELEVENLABS_API_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
+# Trade a little audio quality for a faster first byte (0 = default, 4 = max)
+ELEVENLABS_STREAMING_LATENCY = 3
+ELEVENLABS_HEADERS = {
+    "Accept": "audio/mpeg",
+    "Content-Type": "application/json"
+}
+
+# One pooled session so repeated TTS calls reuse the TLS connection to ElevenLabs
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Generated speech is cached next to the other audio so /audio/<filename> can serve it
+AUDIO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'audio')
+AUDIO_CHUNK_SIZE = 8192
+# Least recently used speech is evicted once the cache outgrows this
+TTS_CACHE_MAX_BYTES = int(float(os.getenv('TTS_CACHE_MAX_MB', '200')) * 1024 * 1024)
+
+def tts_cache_filename(text: str) -> str:
+    """Content-addressed file name for the speech generated for text with the current voice."""
+    digest = hashlib.blake2b((text + ELEVENLABS_VOICE_ID).encode(), digest_size=16).hexdigest()
+    return f"tts-{digest}.mp3"
 
 def text_to_speech(text: str) -> bytes:
     """
@@ -27,14 +56,111 @@ def text_to_speech(text: str) -> bytes:
         ValueError: If API key is not found
         requests.exceptions.RequestException: If API request fails
     """
-    if not ELEVENLABS_API_KEY:
-        raise ValueError("ELEVENLABS_API_KEY not found in environment")
+    return b"".join(text_to_speech_stream(text))
+
+def text_to_speech_stream(text: str) -> Iterator[bytes]:
+    """
+    Convert text to speech using ElevenLabs API, yielding MP3 chunks as they arrive.
     
-    headers = {
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-        "xi-api-key": ELEVENLABS_API_KEY
-    }
+    Results are cached on disk by text and voice, so repeated text (e.g.
+    replayed questions) doesn't call the API again. Streamed audio is only
+    added to the cache once it has been received in full.
+    
+    Args:
+        text: Text to convert to speech
+        
+    Yields:
+        Chunks of audio data (MP3 format)
+        
+    Raises:
+        ValueError: If API key is not found
+        requests.exceptions.RequestException: If API request fails
+    """
+    cache_path = os.path.join(AUDIO_DIR, tts_cache_filename(text))
+    try:
+        _mark_used(cache_path)
+        with open(cache_path, 'rb') as f:
+            logger.info("[TTS] Cache hit for text: %s...", text[:50])
+            while chunk := f.read(AUDIO_CHUNK_SIZE):
+                yield chunk
+        return
+    except FileNotFoundError:
+        pass
+    
+    with _request_speech(text) as response:
+        tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        cache_file = _open_cache_file(tmp_path)
+        audio_size = 0
+        try:
+            for chunk in response.iter_content(chunk_size=AUDIO_CHUNK_SIZE):
+                if cache_file:
+                    cache_file.write(chunk)
+                audio_size += len(chunk)
+                yield chunk
+            logger.info("[TTS] Successfully generated audio (%s bytes)", audio_size)
+            if cache_file:
+                cache_file.close()
+                # Atomic rename, so readers never see a partial file
+                os.replace(tmp_path, cache_path)
+                _evict_cache()
+        finally:
+            if cache_file:
+                cache_file.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def _mark_used(cache_path: str) -> None:
+    """
+    Record a use of cached speech for eviction. Only atime is updated: the file
+    is also served at /audio/<name> as immutable, and its ETag/Last-Modified
+    come from mtime.
+    """
+    os.utime(cache_path, ns=(time.time_ns(), os.stat(cache_path).st_mtime_ns))
+
+def mark_cached_audio_used(filename: str) -> None:
+    """Record that cached speech was served directly from /audio/<filename>, so eviction keeps it."""
+    if not (filename.startswith('tts-') and filename.endswith('.mp3')):
+        return
+    try:
+        _mark_used(os.path.join(AUDIO_DIR, os.path.basename(filename)))
+    except FileNotFoundError:
+        pass
+
+def _evict_cache() -> None:
+    """Delete the least recently used cached speech until the cache fits in TTS_CACHE_MAX_BYTES."""
+    entries = []
+    with os.scandir(AUDIO_DIR) as it:
+        for entry in it:
+            if entry.name.startswith('tts-') and entry.name.endswith('.mp3'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= TTS_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def _open_cache_file(path: str):
+    """Open a cache file for writing, or return None (audio is still streamed) if that fails."""
+    try:
+        return open(path, 'wb')
+    except OSError as e:
+        logger.error("[TTS ERROR] Failed to cache audio: %s", e)
+        return None
+
+def _request_speech(text: str) -> requests.Response:
+    """Start a streaming ElevenLabs request for text and return the response once headers arrive."""
+    api_key = os.environ.get('ELEVENLABS_API_KEY')
+    if not api_key:
+        raise ValueError("ELEVENLABS_API_KEY not found in environment")
     
     data = {
         "text": text,
@@ -46,15 +172,21 @@ def text_to_speech(text: str) -> bytes:
     }
     
     try:
-        print(f"[TTS] Generating speech for text: {text[:50]}...")
-        response = requests.post(ELEVENLABS_API_URL, json=data, headers=headers, timeout=30)
+        logger.info("[TTS] Generating speech for text: %s...", text[:50])
+        response = _session.post(
+            ELEVENLABS_API_URL,
+            params={"optimize_streaming_latency": ELEVENLABS_STREAMING_LATENCY},
+            data=orjson.dumps(data),
+            headers={**ELEVENLABS_HEADERS, "xi-api-key": api_key},
+            timeout=30,
+            stream=True
+        )
         response.raise_for_status()
-        print(f"[TTS] Successfully generated audio ({len(response.content)} bytes)")
-        return response.content
+        return response
     except requests.exceptions.RequestException as e:
-        print(f"[TTS ERROR] ElevenLabs API error: {e}")
+        logger.error("[TTS ERROR] ElevenLabs API error: %s", e)
         if hasattr(e, 'response') and e.response is not None:
-            print(f"[TTS ERROR] Response status: {e.response.status_code}")
-            print(f"[TTS ERROR] Response text: {e.response.text[:500]}")
+            logger.error("[TTS ERROR] Response status: %s", e.response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[TTS ERROR] Response text: %s", e.response.text[:500])
         raise
-